@@ -1,13 +1,44 @@
 
 from argparse import ArgumentParser, Action as ArgAction
 from asyncio import gather, run
-from cProfile import run as prun
-from hashlib import sha256, blake2b, new as newhash
-from json import dumps
+from functools import lru_cache
+from hashlib import new as newhash
 from logging import getLogger, StreamHandler, Formatter
+from os.path import realpath, islink, join as pathjoin, split as pathsplit
 from pathlib import Path
 
-from spraydryfs.db import connect
+try:
+    #libsodium's BLAKE2b ships vectorized compression kernels
+    from nacl.hashlib import blake2b as sodium_blake2b, BYTES_MAX as SODIUM_BLAKE2B_BYTES
+except ImportError:
+    sodium_blake2b = None
+else:
+    class SodiumBlake2b(sodium_blake2b):
+        '''
+        PyNaCl only hashes bytes, while chunks may come as memoryviews. Its
+        default digest is also half the size of hashlib's, which would give
+        the same name to different hashes.
+        '''
+        def __init__(self, data=b'', digest_size=SODIUM_BLAKE2B_BYTES, **kwargs):
+            super().__init__(digest_size=digest_size, **kwargs)
+            if data:
+                self.update(data)
+        def update(self, data):
+            super().update(bytes(data))
+            return None
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    #Not cryptographic, but fast enough to leave hashing to the disk
+    from xxhash import xxh3_64, xxh3_128
+except ImportError:
+    xxh3_64 = xxh3_128 = None
+
+from spraydryfs.db import ensure_schema
 from spraydryfs.spraydry import SprayDryStore, algosplit, make_rehydrate_entry
 from spraydryfs.rehydrate import Rehydrator
 from spraydryfs.fuse import SprayDryFS, runSprayDryFS
@@ -20,11 +51,12 @@ class Mountpoint(ArgAction):
         #TODO: Some more validation here:
         #   Path is writable
         #   Root name and version are good
-        namespace.mount.append({
+        #Never mutate the list in place, it may be the parser's default
+        namespace.mount = [*namespace.mount, {
             'root_name': values[0]
             , 'root_version': values[1]
-            , 'mount': Path(values[2]).resolve()
-            })
+            , 'mount': Path(realpath(values[2]))
+            }]
         return None
 
 class IngestSource(ArgAction):
@@ -42,16 +74,16 @@ class IngestSource(ArgAction):
             , 'hash': hsh
             , 'rehydrate_name': values[3]
             , 'rehydrate_version': values[4]
-            , 'source': Path(values[5]).resolve()
+            , 'source': Path(realpath(values[5]))
             }
         if namespace.ingest:
             existing = namespace.ingest[0]
             for key in ('rehydrate_name', 'rehydrate_version'):
                 if not existing[key] == res[key]:
                     raise ValueError('Mismatched ingestion config value that should be shared between roots', key)
-            if not existing['hash']().name == res['hash']().name:
+            if not existing['hash'].name == res['hash'].name:
                 raise ValueError('Mismatched ingestion config value that should be shared between roots', 'hash')
-        namespace.ingest.append(res)
+        namespace.ingest = [*namespace.ingest, res]
         return None
 
 class TrainSource(ArgAction):
@@ -60,19 +92,38 @@ class TrainSource(ArgAction):
         #   Path is readable
         if len(values) < 5:
             raise ValueError('Training needs at least one data source')
-        namespace.train.append({
+        namespace.train = [*namespace.train, {
             'rehydrate_name': values[0]
             , 'rehydrate_version': values[1]
             , 'sprayer_config': algosplit(values[2])
             , 'dryer_config': algosplit(values[3])
-            , 'source': list(sorted(
-                Path(src).resolve()
-                for src in values[4:]
-                ))
-            })
+            , 'source': [
+                Path(src)
+                #Deduplicate and sort as plain strings
+                for src in sorted({resolve_source(src): None for src in values[4:]})
+                ]
+            }]
         return None
 
-def parse_args():
+@lru_cache(maxsize=1024)
+def resolve_directory(path):
+    return realpath(path)
+
+def resolve_source(path):
+    '''
+    Resolves a path, sharing the work for parent directories between
+    sources. Only a symlink in the last component needs a full resolve.
+    '''
+    parent, name = pathsplit(path)
+    if name in ('', '.', '..'):
+        return realpath(path)
+    res = pathjoin(resolve_directory(parent or '.'), name)
+    if islink(res):
+        return realpath(res)
+    return res
+
+@lru_cache(maxsize=None)
+def make_parser():
     parser = ArgumentParser(
         prog='spraydryfs'
         , description='The Instant File System: Spray, dry, rehydrate!'
@@ -111,7 +162,10 @@ def parse_args():
         , action=TrainSource
         , default=[]
         )
-    return parser.parse_args()
+    return parser
+
+def parse_args(args=None):
+    return make_parser().parse_args(args)
 
 def mkLogger(loglevel):
     logger = getLogger('spraydry')
@@ -127,6 +181,8 @@ async def main():
     args = parse_args()
     logger = mkLogger(args.log_level)
     if args.mount:
+        #Upgrade the schema once up front if need be, the mounts only read
+        ensure_schema(args.dbfile)
         await gather(*(
             runSprayDryFS(
                 args.dbfile
@@ -162,8 +218,19 @@ async def main():
             , ngst['rehydrate_name']
             , ngst['rehydrate_version']
             )
-        for rootcfg in args.ingest:
-            sds.root(rootcfg['root_name'], rootcfg['root_version'], rootcfg['source'])
+        #One transaction for all roots: a failure anywhere rolls back the
+        #entire ingestion run, which is what we want anyway
+        try:
+            sds.begin()
+            try:
+                for rootcfg in args.ingest:
+                    sds.root(rootcfg['root_name'], rootcfg['root_version'], rootcfg['source'])
+            except BaseException:
+                sds.abort()
+                raise
+            sds.commit()
+        finally:
+            sds.close()
     for trn in args.train:
         make_rehydrate_entry(
             args.dbfile
@@ -174,22 +241,78 @@ async def main():
             , trn['source']
             )
     if not args.mount and not args.ingest and not args.train:
-        rh = Rehydrator(args.dbfile, mmap=0)
-        roots = rh.roots()
-        rehydrators = rh.rehydrators()
-        print(dumps({'root': roots, 'rehydrate': rehydrators}, indent=2, sort_keys=True))
+        from json import dumps, loads
+        rh = Rehydrator(args.dbfile)
+        #Only reparsed for pretty-printing
+        print(dumps(loads(rh.listing()), indent=2, sort_keys=True))
+        rh.close()
     return None
 
 
+class TruncatedHash():
+    '''
+    A hash object whose digest is cut down to digest_size bytes. The name is
+    spelled like the argument to hash_algorithm, with the size in bits after
+    a colon; hashlib's own names append it after an underscore, as in
+    sha512_256, which is a different hash from sha512 cut to 256 bits.
+    '''
+    def __init__(self, hashobj, digest_size):
+        self._hashobj = hashobj
+        self.digest_size = digest_size
+        self.name = f'{hashobj.name}:{8 * digest_size}'
+    def update(self, data):
+        self._hashobj.update(data)
+        return None
+    def copy(self):
+        return TruncatedHash(self._hashobj.copy(), self.digest_size)
+    def digest(self):
+        return self._hashobj.digest()[:self.digest_size]
+    def hexdigest(self):
+        return self.digest().hex()
+
+def hash_constructor(name):
+    if name == 'blake3':
+        if blake3 is None:
+            raise ValueError('Hash algorithm needs the blake3 package', name)
+        #Large inputs, like whole files, are hashed on several threads
+        return lambda *data: blake3(*data, max_threads=blake3.AUTO)
+    if name in ('xxh3_64', 'xxh3_128'):
+        if xxh3_128 is None:
+            raise ValueError('Hash algorithm needs the xxhash package', name)
+        return xxh3_64 if name == 'xxh3_64' else xxh3_128
+    name = newhash(name).name
+    if name == 'blake2b' and sodium_blake2b is not None:
+        return SodiumBlake2b
+    return lambda *data: newhash(name, *data)
+
+@lru_cache(maxsize=16)
 def hash_algorithm(instr):
-    hashobj = newhash(instr)
+    '''
+    Takes a hash name, optionally followed by a colon and the number of bits
+    the digest should be truncated to, e.g. blake3:128 .
+    '''
+    name, _, bits = instr.partition(':')
+    mkfull = hash_constructor(name)
+    if not bits:
+        mkhash = mkfull
+    else:
+        bits = int(bits)
+        if bits <= 0 or bits % 8:
+            raise ValueError('Digest length must be a positive multiple of 8 bits', instr)
+        mkhash = lambda *data: TruncatedHash(mkfull(*data), bits // 8)
     def nh(*args):
-        hshobj = hashobj.copy()
-        for a in args:
-            hshobj.update(a)
-        return hshobj
+        #One-shot construction, no prototype state to copy
+        if not args:
+            return mkhash()
+        if len(args) == 1:
+            (arg,) = args
+            if isinstance(arg, memoryview):
+                #Flatten shaped or typed views without copying
+                arg = arg.cast('B')
+            return mkhash(arg)
+        return mkhash(b''.join(args))
+    nh.name = mkhash().name
     return nh
 
 if __name__ == "__main__":
-#    prun('run(main())', sort='tottime')
     run(main())
@@ -0,0 +1,87 @@
+'''
+Compiled chunk border scans, for when numba is installed. numba and numpy
+take a good while to import, so spraydryfs.spraydry only loads this module
+once a sprayer is built, and mounts and listings never do.
+'''
+
+from numba import njit
+from numpy import array, empty, frombuffer, int64, uint8, uint64
+
+from spraydryfs.spraydry import GEAR, crc32_table, gear_masks
+
+CRC32_TABLE = array(crc32_table(), dtype=int64)
+
+@njit(cache=True, nogil=True)
+def crc32_scan(data, table, initializer, cutoff, minimum):
+    '''
+    The loop of crc32_borders over an array of bytes. The register is
+    kept inverted as in zlib, and the number of borders is bounded by
+    the minimum distance between them.
+    '''
+    size = data.shape[0]
+    step = max(minimum, 1)
+    borders = empty(size // step + 1, dtype=int64)
+    count = 0
+    register = initializer ^ 0xffffffff
+    check = minimum
+    for position in range(size):
+        register = table[(register ^ data[position]) & 0xff] ^ (register >> 8)
+        if position >= check and register ^ 0xffffffff < cutoff:
+            borders[count] = position
+            count += 1
+            check = position + step
+    return borders[:count]
+
+def crc32_borders_numba(indata, initializer, cutoff, minimum):
+    '''
+    Like crc32_borders, compiled.
+    '''
+    data = frombuffer(indata, dtype=uint8)
+    return crc32_scan(data, CRC32_TABLE, initializer, cutoff, minimum).tolist()
+
+GEAR_TABLE = array(GEAR, dtype=uint64)
+
+@njit(cache=True, nogil=True)
+def gear_scan(data, table, strict, loose, minimum, maximum, normal):
+    '''
+    The loop of gear_borders over an array of bytes. Every chunk but the
+    last is at least as long as the shorter of minimum and maximum,
+    which bounds the number of borders.
+    '''
+    size = data.shape[0]
+    borders = empty(size // max(min(minimum, maximum), 1) + 1, dtype=int64)
+    count = 0
+    border = 0
+    shift = uint64(1)
+    while size - border > minimum:
+        end = min(border + maximum, size)
+        middle = min(border + max(minimum, normal), end)
+        rolling = uint64(0)
+        position = end
+        for candidate in range(border + minimum, end):
+            rolling = (rolling << shift) + table[data[candidate]]
+            if not rolling & (strict if candidate < middle else loose):
+                position = candidate + 1
+                break
+        if position == size:
+            break
+        borders[count] = position
+        count += 1
+        border = position
+    return borders[:count]
+
+def gear_borders_numba(indata, bits, minimum, maximum, norm=0, average=None):
+    '''
+    Like gear_borders, compiled.
+    '''
+    strict, loose = gear_masks(bits, norm)
+    data = frombuffer(indata, dtype=uint8)
+    return gear_scan(
+        data
+        , GEAR_TABLE
+        , uint64(strict)
+        , uint64(loose)
+        , minimum
+        , maximum
+        , average if norm else 0
+        ).tolist()
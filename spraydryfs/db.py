@@ -3,12 +3,14 @@
 A module for setting up the database. Main reference for the schema.
 '''
 
+from itertools import islice
 from sqlite3 import connect as sqlite3_connect
 
 '''
 The rehydrate table contains configurations for spraying, i.e. turning
 ingested data into chunks suitable for storage, and drying, i.e. compressing
-each individual chunk.
+each individual chunk. The data column holds a trained compression dictionary
+where the algorithm uses one; empty data means compressing without one.
 '''
 
 CREATE_REHYDRATE = '''CREATE TABLE IF NOT EXISTS rehydrate (
@@ -26,6 +28,19 @@ VALUES (0, 'nocompress-fixed', '0.1.0', 'fixed size:0x2000', 'nocompress', X'')
     , (1, 'nocompress-crc32', '0.1.0', 'crc32 cutoff:0x000a0000 initializer:0xfacade00 max:0x4000 min:0x0800', 'nocompress', X'')
 '''
 
+'''
+Configurations added later than the first two get whatever id is free, as
+existing databases may already have given theirs to trained configurations.
+They are told apart by name and version alone. The zstd-gear maximum keeps
+dried chunks inline on PAGE_SIZE pages only; databases created with smaller
+pages store its larger chunks in overflow pages.
+'''
+
+SETUP_REHYDRATE_LATER = '''INSERT OR IGNORE INTO rehydrate (name, version, chunking, algorithm, data)
+VALUES ('zstd-crc32', '0.1.0', 'crc32 cutoff:0x000a0000 initializer:0xfacade00 max:0x4000 min:0x0800', 'zstd level:0x03', X'')
+    , ('zstd-gear', '0.1.0', 'gear bits:0x0d max:0x3f61 min:0x0800', 'zstd level:0x03', X'')
+'''
+
 '''
 Chunks are stored in the chunk table. To avoid SQLite problems around blob
 storage, chunk metadata - the chunk's hash, its uncompressed size, the
@@ -60,6 +75,9 @@ directory's contents are currently only recorded in the entry table.
 The database does not enforce the requirement that the chunks in a file leave
 no gaps and do not overlap. A one-shot verification can be done via a
 outer self-join of content using offset + size as the upper chunk limit.
+Since a file's rehydrate configuration is fixed by the file itself, content
+is keyed by file and offset alone. This keeps the clustered key narrow and
+lets the read path's range scan run directly on the table.
 '''
 
 CREATE_FILE = '''CREATE TABLE IF NOT EXISTS file (
@@ -83,7 +101,7 @@ CREATE_CONTENT = '''CREATE TABLE IF NOT EXISTS content (
     , chunk INTEGER NOT NULL
         REFERENCES chunk (id)
         ON DELETE RESTRICT
-    , PRIMARY KEY (file, rehydrate, offset)
+    , PRIMARY KEY (file, offset)
     , FOREIGN KEY (chunk, rehydrate, size)
         REFERENCES chunkhash (id, rehydrate, size)
         ON DELETE RESTRICT
@@ -107,6 +125,10 @@ and correctness is guaranteed by other means, e.g. by nuking the database if
 an ingestion failure occurs. The AUTOINCREMENT penalty could also be mitigated
 by explicitly manipulating the sqlite_sequence table after a rollback.
 Reference for all of this is https://sqlite.org/autoinc.html .
+The entry table deliberately stays a rowid table: with id as INTEGER PRIMARY
+KEY the rowid B-tree already holds every column, so a lookup by id is a single
+descent. WITHOUT ROWID would not save anything there and would lose automatic
+id assignment, see https://sqlite.org/withoutrowid.html .
 '''
 
 CREATE_ENTRY = '''CREATE TABLE IF NOT EXISTS entry (
@@ -115,7 +137,7 @@ CREATE_ENTRY = '''CREATE TABLE IF NOT EXISTS entry (
         REFERENCES file (id)
     , name BLOB NOT NULL
     , isdirectory BOOL NOT NULL
-    , mode BLOB NOT NULL
+    , mode INTEGER NOT NULL
     , size INTEGER NOT NULL
     , file INTEGER NOT NULL
         REFERENCES file (id)
@@ -133,33 +155,193 @@ CREATE_ROOT = '''CREATE TABLE IF NOT EXISTS root (
     , name TEXT NOT NULL
     , version TEXT NOT NULL
     , isdirectory BOOL NOT NULL
-    , mode BLOB NOT NULL
+    , mode INTEGER NOT NULL
     , size INTEGER NOT NULL
     , file INTEGER NOT NULL
         REFERENCES file (id)
     , UNIQUE (name, version)
 );'''
 
-def connect(dbpath, mmap=None):
+'''
+Directory listings and lookups go by directory and name. The index carries
+every column those queries project, so SQLite never has to visit the entry
+table itself.
+'''
+
+CREATE_INDEX_ENTRY = '''CREATE INDEX IF NOT EXISTS idx_entry_dir
+    ON entry (directory, name, id, isdirectory, mode, size, file);'''
+
+'''
+Up to schema version 3, modes were stored as two little-endian bytes. The
+modeint function doing the conversion is registered during the upgrade.
+'''
+
+MIGRATE_MODE = (
+    "UPDATE entry SET mode = modeint(mode) WHERE typeof(mode) = 'blob'"
+    , "UPDATE root SET mode = modeint(mode) WHERE typeof(mode) = 'blob'"
+    )
+
+'''
+Databases created before schema version 2 key content by (file, rehydrate,
+offset), which forces a sort on every range read. They are recognised by the
+width of that key and get the table rebuilt under the current key; dropping
+the old table also drops the idx_content_lookup index it may carry.
+'''
+
+CONTENT_KEY_WIDTH = "SELECT count(*) FROM pragma_table_info('content') WHERE pk > 0"
+
+MIGRATE_CONTENT = (
+    CREATE_CONTENT.replace('content (', 'content_rebuild (', 1)
+    , '\n'.join([
+        'INSERT INTO content_rebuild (file, rehydrate, offset, size, chunk)'
+        , 'SELECT file, rehydrate, offset, size, chunk FROM content'
+        ])
+    , 'DROP TABLE content'
+    , 'ALTER TABLE content_rebuild RENAME TO content'
+    )
+
+'''
+The complete schema in creation order. Bump SCHEMA_VERSION whenever it
+changes so that existing databases pick up the additions on their next
+connect; up to date databases skip the DDL altogether.
+'''
+
+SCHEMA = (
+    CREATE_REHYDRATE
+    , SETUP_REHYDRATE
+    , SETUP_REHYDRATE_LATER
+    , CREATE_CHUNKHASH
+    , CREATE_CHUNK
+    , CREATE_FILE
+    , CREATE_CONTENT
+    , CREATE_ENTRY
+    , CREATE_ROOT
+    , CREATE_INDEX_ENTRY
+    )
+
+SCHEMA_VERSION = 7
+
+'''
+Readers map as much of the database as SQLite allows. Builds cap this at
+SQLITE_MAX_MMAP_SIZE, commonly just under 2 GiB, and clamp larger requests
+silently, so asking for more only helps where the cap was raised.
+'''
+
+READER_MMAP = 1 << 33
+
+'''
+Writers create databases with PAGE_SIZE pages. A chunk row stays on its leaf
+page as long as its record is at most 35 bytes short of the page size, beyond
+that the blob spills into an overflow page and costs a second page read. The
+id lives in the rowid, so the record is the blob plus a five byte header.
+'''
+
+PAGE_SIZE = 0x4000
+
+CHUNK_INLINE = PAGE_SIZE - 35 - 5
+
+def chunk_inline(conn):
     '''
-    Sets up a writer connection to the database. dbpath must be in uri form.
+    Like CHUNK_INLINE, for the pages the database actually has. Databases
+    created before PAGE_SIZE was raised keep their smaller pages.
     '''
+    (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+    return page_size - 35 - 5
+
+def connect(dbpath, mmap=None, readonly=False):
+    '''
+    Sets up a connection to the database. dbpath must be in uri form or a
+    plain file path.
+    Writer connections run the schema setup; the page size only takes effect
+    on a fresh database. They leave memory mapping off unless asked, so as not
+    to mix mapped pages with WAL writes.
+    Reader connections open the file read-only, skip the schema, and map up
+    to READER_MMAP bytes of the database by default.
+    '''
+    if readonly:
+        return open_reader(dbpath, READER_MMAP if mmap is None else mmap)
     conn = sqlite3_connect(dbpath, uri=True)
     conn.isolation_level = None
+    conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
     conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA wal_autocheckpoint=10000")
     conn.execute("PRAGMA foreign_keys=ON")
     if mmap is not None:
         conn.execute(f"PRAGMA mmap_size={mmap}")
-    for q in [
-        CREATE_REHYDRATE
-        , SETUP_REHYDRATE
-        , CREATE_CHUNKHASH
-        , CREATE_CHUNK
-        , CREATE_FILE
-        , CREATE_CONTENT
-        , CREATE_ENTRY
-        , CREATE_ROOT
-        ]:
-        conn.execute(q)
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version < SCHEMA_VERSION:
+        for q in SCHEMA:
+            conn.execute(q)
+        if version < 4:
+            conn.create_function(
+                'modeint', 1, lambda mode: int.from_bytes(mode, 'little'), deterministic=True
+                )
+            for q in MIGRATE_MODE:
+                conn.execute(q)
+        if version < 7:
+            (width,) = conn.execute(CONTENT_KEY_WIDTH).fetchone()
+            if width > 2:
+                conn.execute('BEGIN')
+                for q in MIGRATE_CONTENT:
+                    conn.execute(q)
+                conn.execute('COMMIT')
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
     return conn
 
+def ensure_schema(dbpath):
+    '''
+    Brings the schema of an existing database up to date. Reader connections
+    cannot do this themselves, so a short-lived writer is opened, but only
+    if the schema is behind; an up to date database is never written to. A
+    missing database is an error rather than created empty.
+    '''
+    reader = open_reader(dbpath, 0)
+    try:
+        (version,) = reader.execute("PRAGMA user_version").fetchone()
+    finally:
+        reader.close()
+    if version < SCHEMA_VERSION:
+        close(connect(with_mode(dbpath, 'rw')))
+    return None
+
+def with_mode(dbpath, mode):
+    '''
+    The database path as a uri opening the file in the given mode.
+    '''
+    uri = dbpath if dbpath.startswith('file:') else 'file:' + dbpath
+    return uri + ('&' if '?' in uri else '?') + 'mode=' + mode
+
+def open_reader(dbpath, mmap=READER_MMAP):
+    '''
+    Opens a read-only connection without touching the schema. It may be
+    closed from a thread other than the one using it.
+    '''
+    conn = sqlite3_connect(with_mode(dbpath, 'ro'), uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA mmap_size={mmap}")
+    return conn
+
+def close(conn):
+    '''
+    Lets SQLite update its planner statistics, then closes the connection.
+    '''
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    return None
+
+def bulk_insert(conn, sql, rows, batch=10000):
+    '''
+    Feeds rows from an iterable to executemany in batches. Each batch is
+    materialized before insertion, so producing rows may itself query conn.
+    '''
+    rows = iter(rows)
+    while True:
+        part = list(islice(rows, batch))
+        if not part:
+            return None
+        conn.executemany(sql, part)
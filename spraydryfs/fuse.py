@@ -4,7 +4,10 @@ Translation from the content-oriented logic of spraydryfs.rehydrate to the
 tree-oriented logic of the POSIX file system standard as demanded by libfuse.
 '''
 
+from asyncio import create_task, to_thread
+from cachetools import LRUCache
 from errno import ENOENT, EACCES
+from itertools import count
 from logging import getLogger, StreamHandler, Formatter
 from os import getuid, getgid, O_RDWR, O_WRONLY
 from pyfuse3 import (
@@ -62,6 +65,12 @@ class SprayDryFS(Operations):
         , mount=None
         , logger=None
         , loglevel='INFO'
+        , lookup_cache=0x10000
+        , attr_cache=0x10000
+        , chunk_cache=0x4000000
+        , prefetch=0x40000
+        , threads=None
+        , timeout=3600.0
         ):
         '''
         Setting up shop with a reader and a root.
@@ -69,13 +78,28 @@ class SprayDryFS(Operations):
         self._logger = logger if logger is not None else self._mklogger(loglevel)
         self._db = dbpath
         self._mount = None if mount is None else mount.resolve(strict=True)
-        self._rehydrator = Rehydrator(dbpath, mmap=mmap)
+        self._rehydrator = Rehydrator(
+            dbpath
+            , mmap=mmap
+            , chunk_cache=chunk_cache
+            , entry_cache=attr_cache
+            , threads=threads
+            )
         self._root = self._rehydrator.root(rootname, rootversion)
         if self._root is None:
             raise ValueError('No such root', rootname, rootversion)
         self._uid = getuid()
         self._gid = getgid()
         self._inode_offset = ROOT_INODE #Offset to ensure that reserved inodes are not used
+        self._dirhandle = count(1)
+        self._dirlistings = {}
+        self._lookups = LRUCache(maxsize=lookup_cache)
+        self._attrs = LRUCache(maxsize=attr_cache)
+        self._timeout = timeout
+        self._root_attrs = self._mkattrs(self._root)
+        self._prefetch = prefetch
+        self._readends = {}
+        self._prefetching = set()
     async def __aenter__(self):
         '''
         Set up FUSE if a mountpoint is given.
@@ -85,6 +109,7 @@ class SprayDryFS(Operations):
         fuseenable()
         fuse_options = set(default_options)
         fuse_options.add('fsname=spraydryfs')
+        fuse_options.add('ro')
         self._logger.debug('FUSE options: %s', fuse_options)
         #Ideally this would take a Path - libfuse is okay with that, but pyfuse3 is not
         fuseinit(
@@ -107,6 +132,8 @@ class SprayDryFS(Operations):
         if self._mount is not None:
             self._logger.info('Unmounting')
             fuseclose(unmount=True)
+        for task in self._prefetching:
+            task.cancel()
         self._rehydrator.close()
         self._logger.info('Closed')
         return None
@@ -117,7 +144,7 @@ class SprayDryFS(Operations):
         if self._mount is not None:
             self._logger.info('Running on %s', self._mount)
             return await fusemain()
-        self._logger.warn('No mountpoint configured, nothing to do')
+        self._logger.warning('No mountpoint configured, nothing to do')
         return None
     def _mklogger(self, level):
         '''
@@ -134,7 +161,13 @@ class SprayDryFS(Operations):
     def _mkattrs(self, inentry):
         '''
         Translate spraydryfs.rehydrate.Entry to pyfuse3.EntryAttributes.
+        Nothing ever changes in a mounted root, so results are cached by
+        inode, and the kernel may keep them for timeout seconds.
         '''
+        inode = ROOT_INODE if inentry.inode is None else inentry.inode + self._inode_offset
+        entry = self._attrs.get(inode)
+        if entry is not None:
+            return entry
         entry = EntryAttributes()
         entry.st_mode = inentry.mode
         entry.st_size = inentry.size
@@ -143,36 +176,51 @@ class SprayDryFS(Operations):
         entry.st_mtime_ns = 0
         entry.st_uid = self._uid
         entry.st_gid = self._gid
-        entry.st_ino = ROOT_INODE if inentry.inode is None else inentry.inode + self._inode_offset
+        entry.st_ino = inode
+        entry.entry_timeout = self._timeout
+        entry.attr_timeout = self._timeout
+        self._attrs[inode] = entry
         return entry
     async def getattr(self, inode, ctx=None):
         '''
-        Exactly what it says on the tin.
+        Exactly what it says on the tin. The root's attributes are built
+        once up front, as they are asked for all the time.
         '''
         self._logger.debug('GetAttr: Inode %s', inode)
         if inode == ROOT_INODE:
-            return self._mkattrs(self._root)
+            return self._root_attrs
         entry = self._rehydrator.attributes(inode - self._inode_offset)
         if entry is None:
-            logger.warn('Inode %s not found', inode)
+            self._logger.warning('Inode %s not found', inode)
             raise FUSEError(ENOENT)
         res = self._mkattrs(entry)
         return res
     async def lookup(self, parent_inode, name, ctx=None):
         '''
-        Exactly what it says on the tin.
+        Exactly what it says on the tin. Names seen in a directory listing or
+        an earlier lookup are answered from memory; anything else is looked
+        up among the contents of the parent's directory file.
         '''
         self._logger.debug('Lookup at inode %s for name %s', parent_inode, name)
+        entry = self._lookups.get((parent_inode, name))
+        if entry is not None:
+            return self._mkattrs(entry)
         if parent_inode == ROOT_INODE:
-            entry = self._rehydrator.entry(self._root.file, name)
+            parent = self._root
         else:
-            entry = self._rehydrator.entry(parent_inode - self._inode_offset, name)
+            parent = self._rehydrator.attributes(parent_inode - self._inode_offset)
+        if parent is None or not parent.isdir:
+            raise FUSEError(ENOENT)
+        entry = self._rehydrator.entry(parent.file, name)
         if entry is None:
             raise FUSEError(ENOENT)
+        self._lookups[(parent_inode, name)] = entry
         return self._mkattrs(entry)
     async def opendir(self, inode, ctx):
         '''
-        Exactly what it says on the tin.
+        Snapshot the directory listing under a fresh handle. Subsequent
+        readdir calls are served from the snapshot, and its names are
+        remembered for lookup.
         '''
         self._logger.debug('Opendir at inode %s', inode)
         if inode == ROOT_INODE:
@@ -181,26 +229,34 @@ class SprayDryFS(Operations):
             entry = self._rehydrator.attributes(inode - self._inode_offset)
         if entry is None or not entry.isdir:
             raise FUSEError(ENOENT)
-        return inode
+        listing = [e for _, e in self._rehydrator.listgen(entry.file)]
+        for e in listing:
+            self._lookups[(inode, e.name)] = e
+        fh = next(self._dirhandle)
+        self._dirlistings[fh] = listing
+        return fh
     async def readdir(self, fh, start_id, token):
         '''
-        Exactly what it says on the tin. Reading a normal file as a directory
-        does not raise an error, but instead returns no entries.
+        Exactly what it says on the tin. The offset handed to the kernel is
+        the position in the snapshot taken by opendir.
         '''
-        if fh == ROOT_INODE:
-            entryid = None
-            gen = self._rehydrator.listgen(self._root.file, offset=start_id)
-        else:
-            entryid = fh = self._offset
-            gen = self._rehydrator.listgen(fh - self._inode_offset, offset=start_id)
+        listing = self._dirlistings[fh]
         self._logger.debug(
-            'Reading directory at inode %s, offset %s, entryid %s'
-            , fh, start_id, entryid
+            'Reading directory handle %s, offset %s, %s entries'
+            , fh, start_id, len(listing)
             )
-        for entrynum, entry in gen:
+        for position in range(start_id, len(listing)):
+            entry = listing[position]
             attrs = self._mkattrs(entry)
-            if not readdir_reply(token, entry.name, self._mkattrs(entry), entrynum):
+            if not readdir_reply(token, entry.name, attrs, position + 1):
                 return
+    async def releasedir(self, fh):
+        '''
+        Drop the directory snapshot.
+        '''
+        self._logger.debug('Releasing directory handle %s', fh)
+        self._dirlistings.pop(fh, None)
+        return None
     async def open(self, inode, flags, ctx):
         '''
         Exactly what it says on the tin.
@@ -208,22 +264,51 @@ class SprayDryFS(Operations):
         self._logger.debug('Opening file at inode %s with flags %s', inode, flags)
         if flags & O_RDWR or flags & O_WRONLY:
             raise FUSEError(EACCES)
-        await self.getattr(inode) #Check inode existence
+        if inode != ROOT_INODE and self._rehydrator.exists(inode - self._inode_offset) is None:
+            raise FUSEError(ENOENT)
         return FileInfo(fh=inode, keep_cache=True)
     async def read(self, fh, off, size):
         '''
-        Exactly what it says on the tin.
+        Exactly what it says on the tin. Reads run on worker threads, so reads
+        of different files overlap. A read continuing where the previous one
+        on the same handle ended is taken as sequential, and the chunks after
+        it are rehydrated in the background.
         '''
+        sequential = self._readends.get(fh) == off
+        self._readends[fh] = off + size
         if fh == ROOT_INODE:
             fileid = self._root.file
             self._logger.debug(
                 'Reading from root inode %s, offset %s, size %s, fileid %s'
                 , fh, off, size, fileid
                 )
-            return self._rehydrator.pread(self._root.file, off, size)
+            res = await to_thread(self._rehydrator.pread, fileid, off, size)
+            if sequential and self._prefetch:
+                self._background(self._rehydrator.prefetch, fileid, off + size, self._prefetch)
+            return res
         entryid = fh - self._inode_offset
         self._logger.debug(
             'Reading from inode %s, offset %s, size %s, entryid %s'
             , fh, off, size, entryid
             )
-        return self._rehydrator.pread_entry(entryid, off, size)
+        res = await to_thread(self._rehydrator.pread_entry, entryid, off, size)
+        if sequential and self._prefetch:
+            self._background(self._rehydrator.prefetch_entry, entryid, off + size, self._prefetch)
+        return res
+    async def release(self, fh):
+        '''
+        Forget where the last read on the handle ended.
+        '''
+        self._readends.pop(fh, None)
+        return None
+    def _background(self, func, *args):
+        '''
+        Run func on a worker thread once the current request has been
+        answered, keeping a reference to the task until it is done.
+        '''
+        async def run():
+            await to_thread(func, *args)
+        task = create_task(run())
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+        return None
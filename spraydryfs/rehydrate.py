@@ -1,12 +1,21 @@
 
-from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import blake2b
-from sqlite3 import connect
+from json import dumps as json_dumps
+from threading import Lock, local as threading_local
+from typing import NamedTuple
 
-from pyzstd import EndlessZstdDecompressor, ZstdDict
+from pyzstd import ZstdDict, ZstdDecompressor
 
-@dataclass
-class Entry():
+from spraydryfs.db import connect
+
+class Entry(NamedTuple):
+    '''
+    A directory entry as stored. Being a tuple keeps snapshots of large
+    directories compact.
+    '''
     inode: int
     parent: int
     name: bytes
@@ -14,25 +23,114 @@ class Entry():
     mode: int
     size: int
     file: int
-    def __post_init__(self):
-        if isinstance(self.mode, bytes):
-            self.mode = int.from_bytes(self.mode, 'little')
-        return None
+
+'''
+The read path's queries. They are plain constants so that every call hands
+sqlite3 the identical string and hits its statement cache. Lookups by
+directory and name are pointed at the covering index where it exists, as the
+planner prefers the non-covering UNIQUE autoindex otherwise.
+'''
+
+INDEXED_ENTRY = ' INDEXED BY idx_entry_dir'
+
+SELECT_ROOT = 'SELECT isdirectory, mode, size, file FROM root WHERE name = ? AND version = ?'
+
+SELECT_ATTRIBUTES = '\n'.join([
+    'SELECT id, directory, name, isdirectory, mode, size, file'
+    , 'FROM entry'
+    , 'WHERE id = ?'
+    ])
+
+SELECT_EXISTS = 'SELECT isdirectory FROM entry WHERE id = ?'
+
+SELECT_ENTRY = '\n'.join([
+    'SELECT id, directory, name, isdirectory, mode, size, file'
+    , 'FROM entry' + INDEXED_ENTRY
+    , 'WHERE directory = ?'
+    , '  AND name = ?'
+    ])
+
+SELECT_LISTING = '\n'.join([
+    'SELECT id, directory, name, isdirectory, mode, size, file'
+    , 'FROM entry' + INDEXED_ENTRY
+    , 'WHERE directory = ?1'
+    , "  AND name > COALESCE((SELECT name FROM entry WHERE id = ?2), X'')"
+    , 'ORDER BY name'
+    ])
+
+SELECT_LISTING_ENTRY = '\n'.join([
+    'SELECT e.id, e.directory, e.name, e.isdirectory, e.mode, e.size, e.file'
+    , 'FROM entry AS parent'
+    , '  INNER JOIN entry AS e'
+    , '    ON e.directory = parent.file'
+    , 'WHERE parent.id = ?1'
+    , '  AND parent.isdirectory IS TRUE'
+    , "  AND e.name > COALESCE((SELECT name FROM entry WHERE id = ?2), X'')"
+    , 'ORDER BY e.name'
+    ])
+
+SELECT_EXTENTS = 'SELECT rehydrate, chunk, offset, size FROM content WHERE file = ? ORDER BY offset'
+
+SELECT_FILE = 'SELECT file FROM entry WHERE id = ?'
+
+SELECT_CHUNK = 'SELECT data FROM chunk WHERE id = ?'
+
+SELECT_CHUNKS = 'SELECT id, data FROM chunk WHERE id IN (SELECT value FROM json_each(?))'
 
 class Rehydrator():
     '''
     A class to transparently reassemble files from the chunks in the database.
     '''
-    def __init__(self, dbpath, mmap=None):
+    def __init__(
+        self
+        , dbpath
+        , mmap=None
+        , chunk_cache=0x4000000
+        , extent_cache=0x100000
+        , entry_cache=0x10000
+        , threads=None
+        ):
         '''
-        Setting up a readonly connection and the rehydrator function.
+        Setting up a readonly connection and the rehydrator dispatch. Each
+        Rehydrator holds its own connection, so concurrent mounts never share
+        one. Rehydrated chunks are kept up to chunk_cache bytes, since
+        deduplicated and sequential reads keep coming back to the same ones.
+        Reads spanning several uncached chunks rehydrate them on a thread
+        pool, as pyzstd releases the GIL while decompressing.
+        The chunk layout of files being read is kept in memory as well, up to
+        extent_cache chunks in total, so locating the chunks for a read is a
+        bisection rather than a query.
+        Up to entry_cache entries found by id or by directory and name are
+        kept too. The database does not change under a reader, so nothing
+        cached ever goes stale.
+        Reads may come in from any thread; each thread reads through its own
+        connection, opened on first use, while the caches are shared.
         '''
         self._db = dbpath
-        self._reader = connect('file:'+dbpath+'?mode=ro', uri=True)
-        if mmap is not None:
-            self._reader.execute(f'PRAGMA mmap_size={mmap}')
-        self._rehydrate = make_rehydrator(self._reader)
-        self._reader.create_function('rehydrator', 3, self._rehydrate, deterministic=True)
+        self._mmap = mmap
+        self._reader = connect(dbpath, mmap=mmap, readonly=True)
+        self._readers = [self._reader]
+        self._local = threading_local()
+        self._local.reader = self._reader
+        self._lock = Lock()
+        entry_indexed = self._reader.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_entry_dir'"
+            ).fetchone() is not None
+        self._q_entry = SELECT_ENTRY if entry_indexed else SELECT_ENTRY.replace(INDEXED_ENTRY, '')
+        self._q_list = SELECT_LISTING if entry_indexed else SELECT_LISTING.replace(INDEXED_ENTRY, '')
+        #Single-row lookups get a cursor each; generators open their own, as
+        #a shared cursor would be reset under a listing still in progress
+        self._cur_root = self._reader.cursor()
+        self._cur_attr = self._reader.cursor()
+        self._cur_exists = self._reader.cursor()
+        self._cur_entry = self._reader.cursor()
+        self._rehydrate = make_rehydrator(self._connection)
+        self._chunks = LRUCache(maxsize=chunk_cache, getsizeof=len)
+        self._extents = LRUCache(maxsize=extent_cache, getsizeof=lambda extents: len(extents[1]))
+        self._files = LRUCache(maxsize=0x10000)
+        self._entries = LRUCache(maxsize=entry_cache)
+        self._names = LRUCache(maxsize=entry_cache)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='rehydrate')
         return None
     def __enter__(self):
         '''
@@ -47,150 +145,221 @@ class Rehydrator():
         return None
     def close(self):
         '''
-        Closing the database connection.
+        Closing the thread pool and the database connections.
         '''
-        self._reader.close()
+        self._pool.shutdown()
+        for reader in self._readers:
+            reader.close()
         return None
+    def _connection(self):
+        '''
+        The calling thread's connection.
+        '''
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = connect(self._db, mmap=self._mmap, readonly=True)
+            with self._lock:
+                self._readers.append(reader)
+        return reader
     def root(self, name, version):
         '''
         Get the specified root, if possible.
         '''
-        for (risdir, rmode, rsize, rfile) in self._reader.execute(
-            'SELECT isdirectory, mode, size, file FROM root WHERE name = ? AND version = ?'
-            , (name, version)
-            ):
-            return Entry(None, None, name, risdir, rmode, rsize, rfile)
-        return None
+        res = self._cur_root.execute(SELECT_ROOT, (name, version)).fetchone()
+        if res is None:
+            return None
+        return Entry(None, None, name, *res)
     def attributes(self, entryid):
         '''
         Get a specific entry.
         '''
-        q = '\n'.join([
-            'SELECT id, directory, name, isdirectory, mode, size, file'
-            , 'FROM entry'
-            , 'WHERE id = ?'
-            ])
-        res = self._reader.execute(q, (entryid,)).fetchone()
+        with self._lock:
+            entry = self._entries.get(entryid)
+        if entry is not None:
+            return entry
+        res = self._cur_attr.execute(SELECT_ATTRIBUTES, (entryid,)).fetchone()
+        if res is None:
+            return None
+        entry = Entry(*res)
+        with self._lock:
+            self._entries[entryid] = entry
+        return entry
+    def exists(self, entryid):
+        '''
+        Check whether an entry exists without building it. Returns None if
+        it does not, otherwise whether it is a directory.
+        '''
+        with self._lock:
+            entry = self._entries.get(entryid)
+        if entry is not None:
+            return entry.isdir
+        res = self._cur_exists.execute(SELECT_EXISTS, (entryid,)).fetchone()
         if res is None:
             return None
-        return Entry(*res)
+        return bool(res[0])
     def entry(self, dirid, name):
         '''
         Find an entry by directory and name.
         '''
-        q = '\n'.join([
-            'SELECT id, directory, name, isdirectory, mode, size, file'
-            , 'FROM entry'
-            , 'WHERE directory = ?'
-            , '  AND name = ?'
-            ])
-        res = self._reader.execute(q, (dirid, name)).fetchone()
+        with self._lock:
+            entry = self._names.get((dirid, name))
+        if entry is not None:
+            return entry
+        res = self._cur_entry.execute(self._q_entry, (dirid, name)).fetchone()
         if res is None:
             return None
-        return Entry(*res)
-    def listgen(self, dirid, offset=0):
+        entry = Entry(*res)
+        with self._lock:
+            self._names[(dirid, name)] = entry
+            self._entries[entry.inode] = entry
+        return entry
+    def listgen(self, dirid, after=0):
         '''
-        List the complete contents of the directory. The FUSE translation
-        appears to only ever fetch one entry here...
+        List the contents of the directory in name order, starting past the
+        entry with id after. Each entry comes with its id as the token for
+        continuing the listing, so resuming is a seek on the
+        (directory, name) index rather than a renumbering of the directory.
         '''
-        q = '\n'.join([
-            'SELECT rownum, id, directory, name, isdirectory, mode, size, file'
-            , 'FROM ('
-            , '  SELECT ROW_NUMBER() OVER ( ORDER BY name ) AS rownum'
-            , '    , id, directory, name, isdirectory, mode, size, file'
-            , '  FROM entry'
-            , '  WHERE directory = ?'
-            , ')'
-            , 'WHERE rownum > ?'
-            ])
-        for res in self._reader.execute(q, (dirid, offset)):
-            yield res[0], Entry(*res[1:])
-    def listgen_entry(self, entryid, offset=0):
+        for res in self._reader.execute(self._q_list, (dirid, after)):
+            yield res[0], Entry(*res)
+    def listgen_entry(self, entryid, after=0):
         '''
-        List the complete contents of the entry's directory. The FUSE
-        translation appears to only ever fetch one entry here...
+        List the contents of the entry's directory like listgen.
         '''
-        q = '\n'.join([
-            'SELECT rownum, id, directory, name, isdirectory, mode, size, file'
-            , 'FROM ('
-            , '  SELECT ROW_NUMBER() OVER ( ORDER BY e.name ) AS rownum'
-            , '    , e.id'
-            , '    , e.directory'
-            , '    , e.name'
-            , '    , e.isdirectory'
-            , '    , e.mode'
-            , '    , e.size'
-            , '    , e.file'
-            , '  FROM entry as e'
-            , '    INNER JOIN entry AS parent'
-            , '      ON e.directory = parent.file'
-            , '  WHERE parent.id = ?'
-            , '    AND parent.isdirectory IS TRUE'
-            , ')'
-            , 'WHERE rownum > ?'
-            ])
-        for res in self._reader.execute(q, (entryid, offset)):
-            yield res[0], Entry(*res[1:])
+        for res in self._reader.execute(SELECT_LISTING_ENTRY, (entryid, after)):
+            yield res[0], Entry(*res)
+    def _rehydrated(self, rows):
+        '''
+        Get the rehydrated data for rows of (rehydrate, chunk, offset, size),
+        from the cache where possible. When several chunks are missing, they
+        are fetched here in one query and rehydrated in parallel on the thread
+        pool.
+        '''
+        with self._lock:
+            chunks = [self._chunks.get(chunkid) for (_, chunkid, _, _) in rows]
+        missing = [i for i, chunk in enumerate(chunks) if chunk is None]
+        if len(missing) > 1:
+            data = self._chunkdata_many({rows[i][1] for i in missing})
+            jobs = [
+                self._pool.submit(
+                    self._rehydrate.single(rows[i][0])
+                    , rows[i][3]
+                    , data[rows[i][1]]
+                    )
+                for i in missing
+                ]
+            for i, job in zip(missing, jobs):
+                chunks[i] = job.result()
+        elif missing:
+            (i,) = missing
+            rid, chunkid, _, csize = rows[i]
+            chunks[i] = self._rehydrate(rid, csize, self._chunkdata(chunkid))
+        with self._lock:
+            for i in missing:
+                (_, chunkid, _, csize) = rows[i]
+                if csize <= self._chunks.maxsize:
+                    self._chunks[chunkid] = chunks[i]
+        return chunks
+    def _chunkdata(self, chunkid):
+        '''
+        Get a chunk's data as stored.
+        '''
+        (data,) = self._connection().execute(SELECT_CHUNK, (chunkid,)).fetchone()
+        return data
+    def _chunkdata_many(self, chunkids):
+        '''
+        Get the data of several chunks as stored, by chunk id. The ids go
+        in as one JSON array, so the statement is the same for any number.
+        '''
+        return dict(self._connection().execute(
+            SELECT_CHUNKS
+            , (json_dumps(sorted(chunkids)),)
+            ))
+    def _layout(self, fileid):
+        '''
+        Get the offsets and rows of (rehydrate, chunk, offset, size) making
+        up the file, from the cache if possible.
+        '''
+        with self._lock:
+            extents = self._extents.get(fileid)
+        if extents is None:
+            rows = self._connection().execute(SELECT_EXTENTS, (fileid,)).fetchall()
+            extents = ([row[2] for row in rows], rows)
+            if len(rows) <= self._extents.maxsize:
+                with self._lock:
+                    self._extents[fileid] = extents
+        return extents
+    def _rows(self, fileid, offset, size):
+        '''
+        The rows of the chunks overlapping a part of the file.
+        '''
+        offsets, rows = self._layout(fileid)
+        first = max(bisect_right(offsets, offset) - 1, 0)
+        last = bisect_left(offsets, offset + size)
+        if first < last and rows[first][2] + rows[first][3] <= offset:
+            first += 1
+        return rows[first:last]
+    def _file(self, entryid):
+        '''
+        The file behind an entry, None if there is no such entry.
+        '''
+        with self._lock:
+            fileid = self._files.get(entryid)
+        if fileid is None:
+            res = self._connection().execute(SELECT_FILE, (entryid,)).fetchone()
+            if res is None:
+                return None
+            (fileid,) = res
+            with self._lock:
+                self._files[entryid] = fileid
+        return fileid
     def pread(self, fileid, offset, size):
         '''
-        Read a part of the file.
+        Read a part of the file into a single buffer.
         '''
-        return b''.join(self.preadgen(fileid, offset, size))
+        rows = self._rows(fileid, offset, size)
+        return assemble(rows, self._rehydrated(rows), offset, size)
     def preadgen(self, fileid, offset, size):
         '''
         Read a part of the file in blocks roughly corresponding to the chunks
-        in the database.
+        in the database. Partial chunks are handed out as memoryviews rather
+        than copies.
         '''
-        end = offset + size
-        q = '\n'.join([
-            'SELECT rehydrator(co.rehydrate, co.size, ch.data), co.offset, co.size'
-            , 'FROM content AS co'
-            , '  INNER JOIN chunk AS ch'
-            , '    ON co.chunk = ch.id'
-            , 'WHERE co.file = ?1'
-            , '  AND ?2 < (co.offset + co.size)'
-            , '  AND co.offset < (?2 + ?3)'
-            , 'ORDER BY co.offset'
-            ])
-        for (chunk, cstart, csize) in self._reader.execute(
-            q
-            , (fileid, offset, size)
-            ):
-            if offset < cstart and cstart + csize < end:
-                yield chunk
-            else:
-                yield chunk[max(offset - cstart, 0):min(end - cstart, csize)]
+        rows = self._rows(fileid, offset, size)
+        return slicegen(rows, self._rehydrated(rows), offset, size)
+    def prefetch(self, fileid, offset, size):
+        '''
+        Rehydrate the chunks covering a part of the file into the cache
+        without returning them.
+        '''
+        self._rehydrated(self._rows(fileid, offset, size))
+        return None
     def pread_entry(self, entryid, offset, size):
         '''
-        Read a part of the entry's file.
+        Read a part of the entry's file into a single buffer.
         '''
-        return b''.join(self.preadgen_entry(entryid, offset, size))
+        fileid = self._file(entryid)
+        if fileid is None:
+            return bytearray()
+        return self.pread(fileid, offset, size)
     def preadgen_entry(self, entryid, offset, size):
         '''
         Read a part of the entry's file in blocks roughly corresponding to the
         chunks in the database.
         '''
-        end = offset + size
-        q = '\n'.join([
-            'SELECT rehydrator(co.rehydrate, co.size, ch.data), co.offset, co.size'
-            , 'FROM entry AS e'
-            , '  INNER JOIN content AS co'
-            , '    ON e.file = co.file'
-            , '  INNER JOIN chunk AS ch'
-            , '    ON co.chunk = ch.id'
-            , 'WHERE e.id = ?1'
-            , '  AND ?2 < (co.offset + co.size)'
-            , '  AND co.offset < (?2 + ?3)'
-            , 'ORDER BY co.offset'
-            ])
-        for (chunk, cstart, csize) in self._reader.execute(
-            q
-            , (entryid, offset, size)
-            ):
-            if offset < cstart and cstart + csize < end:
-                yield chunk
-            else:
-                yield chunk[max(offset - cstart, 0):min(end - cstart, csize)]
+        fileid = self._file(entryid)
+        if fileid is None:
+            return iter(())
+        return self.preadgen(fileid, offset, size)
+    def prefetch_entry(self, entryid, offset, size):
+        '''
+        Rehydrate the chunks covering a part of the entry's file into the
+        cache without returning them.
+        '''
+        fileid = self._file(entryid)
+        if fileid is not None:
+            self.prefetch(fileid, offset, size)
+        return None
     def rehydrators(self):
         '''
         List all rehydration configurations from the database. Data is given
@@ -232,16 +401,101 @@ class Rehydrator():
                 , 'rehydrate_version': r_version
                 }
         return res
+    def listing(self):
+        '''
+        The combined output of roots and rehydrators as a JSON string, built
+        by SQLite without going through Python objects.
+        Intended for data display.
+        '''
+        self._reader.create_function(
+            'blake2b_hex', 1, lambda data: blake2b(data).hexdigest(), deterministic=True
+            )
+        q = '\n'.join([
+            'SELECT json_object('
+            , "  'root', ("
+            , '    SELECT json_group_object(name, json(versions)) FROM ('
+            , '      SELECT r.name AS name, json_group_object(r.version, json_object('
+            , "        'hash', CAST(substr(f.hash, 1, instr(f.hash, X'2D') - 1) AS TEXT)"
+            , "          || '-' || lower(hex(substr(f.hash, instr(f.hash, X'2D') + 1)))"
+            , "        , 'rehydrate_name', h.name"
+            , "        , 'rehydrate_version', h.version"
+            , '        )) AS versions'
+            , '      FROM root AS r'
+            , '        INNER JOIN file AS f'
+            , '          ON r.file = f.id'
+            , '        INNER JOIN rehydrate AS h'
+            , '          ON f.rehydrate = h.id'
+            , '      GROUP BY r.name'
+            , '      )'
+            , '    )'
+            , "  , 'rehydrate', ("
+            , '    SELECT json_group_object(name, json(versions)) FROM ('
+            , '      SELECT name, json_group_object(version, json_object('
+            , "        'sprayer', chunking"
+            , "        , 'dryer', algorithm"
+            , "        , 'data', CASE WHEN length(data) = 0 THEN ''"
+            , "            ELSE 'blake2b-' || blake2b_hex(data) END"
+            , '        )) AS versions'
+            , '      FROM rehydrate'
+            , '      GROUP BY name'
+            , '      )'
+            , '    )'
+            , '  )'
+            ])
+        (res,) = self._reader.execute(q).fetchone()
+        return res
 
+def slicegen(rows, chunks, offset, size):
+    '''
+    Cut the chunks for rows of (rehydrate, chunk, offset, size) down to the
+    requested part of the file.
+    '''
+    end = offset + size
+    for (_, _, cstart, csize), chunk in zip(rows, chunks):
+        if offset < cstart and cstart + csize < end:
+            yield chunk
+        else:
+            yield memoryview(chunk)[max(offset - cstart, 0):min(end - cstart, csize)]
 
-def make_rehydrator(conn):
-    lookup = {
-        rid: make_rehydrator_single(algorithm, data)
-        for rid, algorithm, data in conn.execute(
-            'SELECT id, algorithm, data FROM rehydrate'
-            )
-        }
-    return lambda i, size, data: lookup[i](size, data)
+def assemble(rows, chunks, offset, size):
+    '''
+    Copy the requested part of the file out of the chunks into a buffer
+    allocated once, cut short where the file ends.
+    '''
+    res = bytearray(size)
+    end = offset + size
+    filled = 0
+    for (_, _, cstart, csize), chunk in zip(rows, chunks):
+        lo = max(offset - cstart, 0)
+        hi = min(end - cstart, csize)
+        filled = cstart + hi - offset
+        res[cstart + lo - offset:filled] = memoryview(chunk)[lo:hi]
+    del res[filled:]
+    return res
+
+def make_rehydrator(connection):
+    '''
+    Dispatches chunks to a rehydrator per rehydrate id. Rehydrators are built
+    on first use, so configurations that are never read cost nothing.
+    connection gives the calling thread's database connection for that;
+    rehydrator.single resolves an id up front for use on threads without one.
+    '''
+    lookup = {}
+    def single(i):
+        res = lookup.get(i)
+        if res is None:
+            conf = connection().execute(
+                'SELECT algorithm, data FROM rehydrate WHERE id = ?'
+                , (i,)
+                ).fetchone()
+            if conf is None:
+                raise ValueError('No such rehydrate configuration', i)
+            res = lookup[i] = make_rehydrator_single(*conf)
+        return res
+    def rehydrator(i, size, data):
+        return single(i)(size, data)
+    rehydrator.single = single
+    return rehydrator
 
 def make_rehydrator_single(algorithm, data):
     parts = algorithm.split()
@@ -266,13 +520,17 @@ def make_rehydrator_single(algorithm, data):
             }
         if not options:
             options = None
-        decompressor = EndlessZstdDecompressor(
-            zstd_dict=ZstdDict(data)
-            , option=options
-            )
+        zstd_dict = ZstdDict(data) if data else None
+        #Chunks are independent frames, so a fresh decompressor per chunk
+        #needs no state carried between calls and is safe on any thread.
+        #Keeping a decompression context per thread instead measured no
+        #faster for chunks of this size, dictionary or not: the dictionary is
+        #digested once by ZstdDict either way. The output is bounded by the
+        #recorded chunk size, so a corrupt frame cannot balloon in memory
         def rehydrator(chunksize, chunkdata):
+            decompressor = ZstdDecompressor(zstd_dict, options)
             chunk = decompressor.decompress(chunkdata, max_length=chunksize)
-            if not chunksize == len(chunk):
+            if not (decompressor.eof and chunksize == len(chunk)):
                 raise RuntimeError('Bad chunk size', chunksize, chunk, chunkdata)
             return chunk
     else:
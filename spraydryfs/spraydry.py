@@ -1,16 +1,88 @@
 
 
-from cachetools import cached
-from mmap import mmap
-from pyzstd import ZstdCompressor, ZstdDict, train_dict, finalize_dict
+from binascii import hexlify
+from cachetools import cached, LRUCache
+from cachetools.keys import hashkey
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import blake2b
+from itertools import islice
+from math import ceil, log
+from mmap import mmap, ACCESS_READ
+from os import open as os_open, close as os_close, cpu_count, fsencode, fstat, pread, scandir, O_NONBLOCK, O_RDONLY
+from pyzstd import CParameter, ZstdCompressor, ZstdDict, train_dict, finalize_dict
+from queue import Queue, Full
 from stat import S_ISDIR, S_ISREG
+from threading import Event, local as threading_local
 from zlib import crc32
 
-from spraydryfs.db import connect
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED
+except ImportError:
+    #Not available on every platform, e.g. macOS
+    posix_fadvise = None
 
+try:
+    #The compiled FastCDC chunker, not the slow pure Python fallback
+    from fastcdc.fastcdc_cy import fastcdc_cy as fastcdc_chunks
+except ImportError:
+    fastcdc_chunks = None
+
+try:
+    from mmap import MADV_SEQUENTIAL
+except ImportError:
+    #Not available on every platform, e.g. Windows
+    MADV_SEQUENTIAL = None
+
+from spraydryfs.db import connect, close, bulk_insert, chunk_inline, CHUNK_INLINE
+
+'''
+Chunk hashes are recorded CHUNK_BATCH at a time, so that each batch costs one
+executemany and a lookup or two rather than a statement per chunk. Lookups
+always bind CHUNK_BATCH hashes, padded with NULL, so there is only ever the
+one statement to prepare.
+'''
+
+CHUNK_BATCH = 0x100
+
+SELECT_CHUNKHASHES = '\n'.join([
+    'SELECT data, id'
+    , 'FROM chunkhash'
+    , 'WHERE rehydrate = ?'
+    , '  AND data IN (' + ', '.join(['?'] * CHUNK_BATCH) + ')'
+    ])
 
 class SprayDryStore():
-    def __init__(self, dbpath, mkhashobj, rehydratename, rehydrateversion, sprayconf=None, dryconf=None):
+    def __init__(
+        self
+        , dbpath
+        , mkhashobj
+        , rehydratename
+        , rehydrateversion
+        , sprayconf=None
+        , dryconf=None
+        , threads=None
+        , window=0x40
+        , readahead=0x40
+        , readahead_size=0x20000
+        , sprayahead=0x100000
+        , lanes=None
+        , spraybehind=0x4
+        ):
+        '''
+        Chunks are dried on a pool of threads while spraying and database
+        writes carry on; up to window chunks per file may be in flight.
+        While drying a directory, the next readahead entries are prepared in
+        the background: files of up to sprayahead bytes are sprayed and
+        hashed on the pool, and the kernel is asked to read ahead the first
+        readahead_size bytes of larger ones. Many small files are thus worked
+        on at once, with only the database writes left in order.
+        Chunk hashes are computed in up to lanes parallel slices of each
+        batch, by default one per CPU up to eight. Larger files are sprayed
+        and hashed on a thread of their own, up to spraybehind batches ahead
+        of the database writes.
+        '''
         self._db = dbpath
         self._mkhashobj = mkhashobj
         self._hashname = mkhashobj().name.encode('utf-8')
@@ -23,20 +95,69 @@ class SprayDryStore():
             , sprayconf
             , dryconf
             )
-    def savepoint(self, path):
-        pathhsh = self._mkhashobj(bytes(path))
-        savepointname = 'savepoint_' + pathhsh.hexdigest()
-        self._writer.execute('SAVEPOINT ' + savepointname)
-        return savepointname
+        self._known = self.load_known()
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dry')
+        self._window = window
+        self._readahead = readahead
+        self._readahead_size = readahead_size
+        self._sprayahead = sprayahead
+        self._lanes = min(cpu_count() or 1, 8) if lanes is None else lanes
+        #Not on the pool: a sprayer waiting for room must never hold up drying
+        self._spraythread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spray')
+        self._spraybehind = spraybehind
+        self._depth = 0
+    def load_known(self):
+        '''
+        Sets up a Bloom filter over the chunk hashes already stored for this
+        rehydrate configuration, with room for as many again.
+        '''
+        (count,) = self._writer.execute(
+            'SELECT count(*) FROM chunkhash WHERE rehydrate = ?'
+            , (self._rehydrate,)
+            ).fetchone()
+        known = HashFilter(max(2 * count, 1 << 20))
+        for (chunkhsh,) in self._writer.execute(
+            'SELECT data FROM chunkhash WHERE rehydrate = ?'
+            , (self._rehydrate,)
+            ):
+            known.add(chunkhsh)
+        return known
+    def close(self):
+        self._spraythread.shutdown()
+        self._pool.shutdown()
+        close(self._writer)
+        return None
+    def begin(self):
+        self._writer.execute('BEGIN IMMEDIATE')
+        return None
+    def commit(self):
+        self._writer.execute('COMMIT')
+        return None
+    def abort(self):
+        self._writer.execute('ROLLBACK')
+        return None
+    def savepoint(self):
+        '''
+        Opens a savepoint nested in the current ones and returns its depth.
+        Savepoints are named after their depth, which is unique among the
+        open ones; with a handful of names, the statements stay cached.
+        '''
+        self._depth += 1
+        self._writer.execute(f'SAVEPOINT savepoint_{self._depth}')
+        return self._depth
     def rollback(self, savepoint):
-        self._writer.execute(f'ROLLBACK TO ' + savepoint)
-        self._writer.execute(f'RELEASE ' + savepoint)
+        self._writer.execute(f'ROLLBACK TO savepoint_{savepoint}')
+        self.release(savepoint)
         return None
     def release(self, savepoint):
-        self._writer.execute(f'RELEASE ' + savepoint)
+        '''
+        Releases the savepoint along with any left open inside it.
+        '''
+        self._writer.execute(f'RELEASE savepoint_{savepoint}')
+        self._depth = savepoint - 1
         return None
     def hash(self, indata):
-        if isinstance(indata, bytes):
+        if isinstance(indata, (bytes, memoryview)):
             return self._hashname + b'-' + self._mkhashobj(indata).digest()
         return self._hashname + b'-' + indata.digest()
     def tmpid(self, path):
@@ -49,55 +170,145 @@ class SprayDryStore():
         if res is None:
             raise ValueError('Could not insert preliminary file id:', path, fakehsh)
         return res[0]
-    def store_chunk(self, fileid, chunk):
-        chunkhsh = self.hash(chunk)
-        res_insert = self._writer.execute(
-            '\n'.join([
-                'INSERT OR IGNORE INTO chunkhash (rehydrate, size, data)'
-                , 'VALUES (?,?,?)'
-                , 'RETURNING id'
-                    ])
-            , (self._rehydrate, len(chunk), chunkhsh)
-            ).fetchone()
-        if res_insert is None:
-            res_existing = self._writer.execute(
+    def store_chunkhashes(self, chunks, hashes):
+        '''
+        Records the hashes of up to CHUNK_BATCH chunks. Returns the chunk id
+        for each chunk and whether it is new, in which case its data still
+        has to be stored. A chunk repeated within the batch is new only the
+        first time.
+        '''
+        probable = [chunkhsh for chunkhsh in hashes if chunkhsh in self._known]
+        ids = self.select_chunkhashes(probable) if probable else {}
+        fresh = {
+            chunkhsh: len(chunk)
+            for chunkhsh, chunk in zip(hashes, chunks)
+            if chunkhsh not in ids
+            }
+        if fresh:
+            self._writer.executemany(
                 '\n'.join([
-                    'SELECT id'
-                    , 'FROM chunkhash'
-                    , 'WHERE rehydrate = ? AND data = ?'
+                    'INSERT OR IGNORE INTO chunkhash (rehydrate, size, data)'
+                    , 'VALUES (?,?,?)'
                     ])
-                , (self._rehydrate, chunkhsh)
-                ).fetchone()
-            if res_existing is None:
+                , [(self._rehydrate, size, chunkhsh) for chunkhsh, size in fresh.items()]
+                )
+            ids.update(self.select_chunkhashes(list(fresh)))
+        res = []
+        for chunkhsh in hashes:
+            chunkid = ids.get(chunkhsh)
+            if chunkid is None:
                 raise RuntimeError('Could neither insert chunk nor retrieve existing', chunkhsh)
-            return res_existing[0]
-        chunkid = res_insert[0]
-        self._writer.execute(
+            new = fresh.pop(chunkhsh, None) is not None
+            if new:
+                self._known.add(chunkhsh)
+            res.append((chunkid, new))
+        return res
+    def hash_batches(self, chunks, filehashobj, lanes=None):
+        '''
+        Yields the chunks in batches of up to CHUNK_BATCH, each along with
+        the hashes of its chunks. The chunks are fed to filehashobj too, so
+        the file hash covers exactly the bytes that were chunked.
+        '''
+        chunks = iter(chunks)
+        while True:
+            batch = list(islice(chunks, CHUNK_BATCH))
+            if not batch:
+                break
+            for _, chunk in batch:
+                filehashobj.update(chunk)
+            yield batch, self.hash_chunks([chunk for _, chunk in batch], lanes)
+        return None
+    def hash_chunks(self, chunks, lanes=None):
+        '''
+        Hashes a batch of chunks. Large enough batches are dealt into one
+        slice per lane, hashed on the pool side by side; hashlib lets go of
+        the GIL for inputs of chunk size, so the lanes run in parallel.
+        Work already running on the pool must ask for a single lane, so as
+        not to wait on the pool itself.
+        '''
+        lanes = self._lanes if lanes is None else lanes
+        if lanes < 2 or len(chunks) < 2 * lanes:
+            return [self.hash(chunk) for chunk in chunks]
+        hashes = [None] * len(chunks)
+        for lane, lanehashes in enumerate(self._pool.map(
+            lambda lane: [self.hash(chunk) for chunk in chunks[lane::lanes]]
+            , range(lanes)
+            )):
+            hashes[lane::lanes] = lanehashes
+        return hashes
+    def select_chunkhashes(self, hashes):
+        '''
+        Maps those of the given hashes that are stored to their chunk ids.
+        '''
+        return dict(self._writer.execute(
+            SELECT_CHUNKHASHES
+            , (self._rehydrate, *hashes, *(None,) * (CHUNK_BATCH - len(hashes)))
+            ))
+    def store_chunkdata(self, pending):
+        '''
+        Stores the dried data of the new chunks among pending pairs of
+        content row and drying job, in one go, and hands back the content
+        rows referring to them.
+        '''
+        self._writer.executemany(
             'INSERT INTO chunk (id, data) VALUES (?,?)'
-            , (chunkid, self._dryer(chunk))
+            , [(row[4], dried.result()) for row, dried in pending if dried is not None]
             )
-        return chunkid
-    def store_content(self, fileid, offset, chunkid):
-        self._writer.execute(
-            '\n'.join([
+        return [row for row, _ in pending]
+    def store_content(self, rows):
+        bulk_insert(
+            self._writer
+            , '\n'.join([
                 'INSERT OR IGNORE INTO content (file, rehydrate, offset, size, chunk)'
-                , 'SELECT ?, rehydrate, ?, size, id'
-                , 'FROM chunkhash'
-                , 'WHERE id = ?'
+                , 'VALUES (?,?,?,?,?)'
                 ])
-            , (fileid, offset, chunkid)
+            , rows
             )
         return None
-    def dry_file(self, path):
-        savepoint = self.savepoint(path)
+    def spray_content(self, fileid, batches):
+        '''
+        Yields the content rows for the file sprayed into hashed batches of
+        chunks. New chunks are dried on the pool; as content refers to
+        chunk, a row only comes out once its chunk has been stored, in
+        order. Chunks are stored half a window at a time, oldest first, so
+        that drying carries on with the rest.
+        '''
+        pending = deque()
+        for batch, hashes in batches:
+            stored = self.store_chunkhashes([chunk for _, chunk in batch], hashes)
+            for (offset, chunk), (chunkid, new) in zip(batch, stored):
+                pending.append((
+                    (fileid, self._rehydrate, offset, len(chunk), chunkid)
+                    , self._pool.submit(self._dryer, chunk) if new else None
+                    ))
+                if len(pending) >= self._window:
+                    yield from self.store_chunkdata([
+                        pending.popleft()
+                        for _ in range(max(self._window // 2, 1))
+                        ])
+        yield from self.store_chunkdata(pending)
+    def dry_file(self, path, sprayed=None):
+        '''
+        Dries a regular file, unless it turns out to be stored already. The
+        result of spray_file may be passed in as a future.
+        '''
+        savepoint = self.savepoint()
         fileid = self.tmpid(path)
+        if sprayed is not None:
+            batches, filehashobj = sprayed.result()
+            self.store_content(self.spray_content(fileid, batches))
+            return self.store_file(savepoint, fileid, filehashobj)
         filehashobj = self._mkhashobj()
-        with open(path, 'rb+') as handle:
-            with mmap(handle.fileno(), 0) as mm:
-                for offset, chunk in self._sprayer(mm):
-                    filehashobj.update(chunk)
-                    chunkid = self.store_chunk(fileid, chunk)
-                    self.store_content(fileid, offset, chunkid)
+        self.store_content(self.spray_content(
+            fileid
+            , self.spray_behind(self.hash_batches(self._sprayer(path), filehashobj))
+            ))
+        return self.store_file(savepoint, fileid, filehashobj)
+    def store_file(self, savepoint, fileid, filehashobj):
+        '''
+        Gives the file its hash, or rolls back to the savepoint in favour of
+        a file with the same hash stored earlier.
+        '''
         filehash = self.hash(filehashobj)
         for (existingid,) in self._writer.execute(
             'SELECT id FROM file WHERE hash = ? AND rehydrate = ?'
@@ -111,55 +322,144 @@ class SprayDryStore():
             )
         self.release(savepoint)
         return fileid, filehash
+    def spray_behind(self, batches):
+        '''
+        Yields the hashed batches, sprayed and hashed on the spraying thread
+        up to spraybehind batches ahead, so that reading, chunking and
+        hashing the file go on while the batches before are written to the
+        database. Errors in spraying are raised here, and stopping early
+        stops the sprayer.
+        '''
+        if not self._spraybehind:
+            yield from batches
+            return None
+        handed = Queue(maxsize=self._spraybehind)
+        stop = Event()
+        def hand_over(item):
+            while not stop.is_set():
+                try:
+                    handed.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        def spray():
+            try:
+                for batch in batches:
+                    if not hand_over(batch):
+                        break
+                else:
+                    hand_over(None)
+            except Exception as e:
+                hand_over(e)
+            finally:
+                batches.close()
+            return None
+        sprayer = self._spraythread.submit(spray)
+        try:
+            while True:
+                batch = handed.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if batch is None:
+                    break
+                yield batch
+        finally:
+            stop.set()
+            sprayer.result()
+        return None
+    def spray_file(self, path):
+        '''
+        Sprays and hashes a whole file, without touching the database. The
+        file is small, and its chunks may wait for their turn a long while,
+        so they are copied out rather than left pinning the file's map.
+        '''
+        filehashobj = self._mkhashobj()
+        #Already on the pool, so hashing chunks takes this one lane
+        batches = [
+            ([(offset, bytes(chunk)) for offset, chunk in batch], hashes)
+            for batch, hashes in self.hash_batches(self._sprayer(path), filehashobj, 1)
+            ]
+        return batches, filehashobj
+    def ahead(self, entry, sprayed):
+        '''
+        Gets a directory entry going before its turn. Small files are
+        sprayed in full, into sprayed by name; the start of larger ones is
+        read into the page cache. Problems are left for drying to report.
+        '''
+        try:
+            stat = entry.stat()
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+        if stat.st_size <= self._sprayahead:
+            sprayed[entry.name] = self._pool.submit(self.spray_file, entry.path)
+        elif posix_fadvise is not None:
+            self._pool.submit(readahead, entry.path, self._readahead_size)
+        return None
     def dry_directory(self, path):
-        savepoint = self.savepoint(path)
+        savepoint = self.savepoint()
         fileid = self.tmpid(path)
         filehashobj = self._mkhashobj()
-        for entry in sorted(path.iterdir()):
-            entryid, entryhash, entrystat = self.dry(entry)
-            entryname = bytes(entry.relative_to(path))
+        entryrows = []
+        #Sorting by name is the order paths within one directory sort in
+        with scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        sprayed = {}
+        for ahead in entries[:self._readahead]:
+            self.ahead(ahead, sprayed)
+        for position, entry in enumerate(entries, self._readahead):
+            if self._readahead and position < len(entries):
+                self.ahead(entries[position], sprayed)
+            entryid, entryhash, entrystat = self.dry(
+                path / entry.name
+                , entry.stat()
+                , sprayed.pop(entry.name, None)
+                )
+            entryname = fsencode(entry.name)
             entrymodebytes = make_modebytes(entrystat)
-            entrysegment = b''.join([
+            #The segment layout, hex name included, fixes every directory hash
+            #stored so far; hexlify produces the same bytes in one step
+            filehashobj.update(b''.join([
                 b'\x00'
                 , entryhash
-                , entrymodebytes 
-                , entryname.hex().encode('utf-8')
-                ])
-            filehashobj.update(entrysegment)
-            self._writer.execute(
-                '\n'.join([
-                    'INSERT OR IGNORE INTO entry ('
-                    , 'directory, name, isdirectory, mode, size, file'
-                    , ') VALUES (?,?,?,?,?,?)'
-                    ])
-                , (fileid, entryname, S_ISDIR(entrystat.st_mode), entrymodebytes, entrystat.st_size, entryid)
+                , entrymodebytes
+                , hexlify(entryname)
+                ]))
+            entryrows.append(
+                (fileid, entryname, S_ISDIR(entrystat.st_mode), entrystat.st_mode, entrystat.st_size, entryid)
                 )
-        filehash = self.hash(filehashobj)
-        for (existingid,) in self._writer.execute(
-            'SELECT id FROM file WHERE hash = ? AND rehydrate = ?'
-            , (filehash, self._rehydrate)
-            ):
-            self.rollback(savepoint)
-            return existingid, filehash
-        self._writer.execute(
-            'UPDATE file SET hash = ? WHERE id = ?'
-            , (filehash, fileid)
+        bulk_insert(
+            self._writer
+            , '\n'.join([
+                'INSERT OR IGNORE INTO entry ('
+                , 'directory, name, isdirectory, mode, size, file'
+                , ') VALUES (?,?,?,?,?,?)'
+                ])
+            , entryrows
             )
-        self.release(savepoint)
-        return fileid, filehash
-    def dry(self, path):
-        stat = path.stat()
+        return self.store_file(savepoint, fileid, filehashobj)
+    def dry(self, path, stat=None, sprayed=None):
+        '''
+        Dries a file or directory. A stat result already at hand may be
+        passed along to save asking again, as may a file sprayed ahead.
+        '''
+        if stat is None:
+            stat = path.stat()
         mode = stat.st_mode
         if S_ISDIR(mode):
             fileid, filehash = self.dry_directory(path)
         elif S_ISREG(mode):
-            fileid, filehash = self.dry_file(path)
+            fileid, filehash = self.dry_file(path, sprayed)
         else:
             raise ValueError('Unsupported file type', path, stat)
         return fileid, filehash, stat
     def root(self, name, version, path):
         realpath = path.resolve(strict=True)
-        self._writer.execute('BEGIN')
+        #Outside of a transaction this acts as BEGIN ... COMMIT, inside one
+        #it lets a batch of roots share a single commit
+        savepoint = self.savepoint()
         committed = False
         try:
             if self._writer.execute(
@@ -170,16 +470,52 @@ class SprayDryStore():
             fileid, filehash, stat = self.dry(realpath)
             self._writer.execute(
                 'INSERT INTO root (name, version, isdirectory, mode, size, file) VALUES (?,?,?,?,?,?)'
-                , (name, version, S_ISDIR(stat.st_mode), make_modebytes(stat), stat.st_size, fileid)
+                , (name, version, S_ISDIR(stat.st_mode), stat.st_mode, stat.st_size, fileid)
                 )
-            self._writer.execute('COMMIT')
+            self.release(savepoint)
             committed = True
         finally:
             if not committed:
-                self._writer.execute('ROLLBACK')
+                self.rollback(savepoint)
         return None
 
+class HashFilter():
+    '''
+    A Bloom filter over chunk hashes. A miss means the hash is definitely not
+    stored, a hit means it most likely is. Since the hashes are digests
+    already, probe positions are derived from their bytes directly, past
+    the name prefix. Digests too short for two independent 8 byte values
+    are stretched by hashing them once more.
+    '''
+    def __init__(self, capacity, error_rate=0.001):
+        self._size = ceil(-capacity * log(error_rate) / log(2)**2)
+        self._probes = max(1, round(self._size / capacity * log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+    def _positions(self, hsh):
+        digest = hsh.partition(b'-')[2]
+        if len(digest) < 16:
+            digest = blake2b(digest, digest_size=16).digest()
+        first = int.from_bytes(digest[-8:], 'little')
+        step = int.from_bytes(digest[-16:-8], 'little') | 1
+        size = self._size
+        return [(first + i * step) % size for i in range(self._probes)]
+    def add(self, hsh):
+        bits = self._bits
+        for pos in self._positions(hsh):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        return None
+    def __contains__(self, hsh):
+        bits = self._bits
+        return all(
+            bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(hsh)
+            )
+
 def make_modebytes(stat):
+    '''
+    The mode as it goes into directory hashes. The database stores it as a
+    plain integer.
+    '''
     return stat.st_mode.to_bytes(2, 'little')
 
 def make_rehydrate_entry(dbfile, name, version, sprayconf, dryconf, datasources):
@@ -222,6 +558,7 @@ def make_mksprayer_dryer(conn, name, version, sprayconf, dryconf, datasources=No
                     ' cannot create a fresh one without required input.'
                 , sprayconf, dryconf, datasources
                 )
+        sprayconf = fit_sprayconf(sprayconf, dryconf, chunk_inline(conn))
         data = mkdata(conn, sprayconf, dryconf, datasources)
         if data is None:
             raise ValueError(
@@ -237,10 +574,33 @@ def make_mksprayer_dryer(conn, name, version, sprayconf, dryconf, datasources=No
                 ])
             , (name, version, algojoin(sprayconf), algojoin(dryconf), data)
             ).fetchone()
-    sprayer = make_sprayer(*sprayconf)
+    sprayer = make_filesprayer(*sprayconf)
     dryer = make_dryer(*dryconf, data)
     return rehydrateID, sprayer, dryer
 
+def fit_sprayconf(sprayconf, dryconf, limit=CHUNK_INLINE):
+    '''
+    Gives a fresh content-defined spraying configuration without a maximum
+    chunk size one that keeps every dried chunk within limit bytes, even if
+    it does not compress at all. The maximum is stored with the config, so
+    existing configurations never change.
+    '''
+    algorithm, params = sprayconf
+    if algorithm not in ('crc32', 'gear', 'fastcdc') or 'max' in params:
+        return sprayconf
+    maximum = min(limit, 0x4000)
+    if dryconf[0] == 'zstd':
+        while zstd_bound(maximum) > limit:
+            maximum -= 1
+    return algorithm, {**params, 'max': maximum}
+
+def zstd_bound(size):
+    '''
+    Worst case size of a zstd frame for size bytes of input, as per
+    ZSTD_COMPRESSBOUND.
+    '''
+    return size + (size >> 8) + (((0x20000 - size) >> 11) if size < 0x20000 else 0)
+
 def mkdata(conn, sprayconf, dryconf, datasources):
     if any(isinstance(dsrc, str) for dsrc in datasources):
         raise NotImplementedError(
@@ -254,7 +614,8 @@ def mkdata(conn, sprayconf, dryconf, datasources):
     if algorithm == 'zstd':
         dictsize = params.get('dictsize')
         if dictsize is None:
-            raise ValueError('Drying algorithm zstd needs parameter dictsize')
+            #Compress without a dictionary
+            return b''
         dictlevel = params.get('dictlevel')
         if dictlevel is None:
             raise ValueError('Drying algorithm zstd needs parameter dictlevel')
@@ -268,23 +629,47 @@ def mkdata(conn, sprayconf, dryconf, datasources):
         )
 
 def trainergen(sprayconf, datasources):
-    sprayer = make_sprayer(*sprayconf)
+    sprayer = make_filesprayer(*sprayconf)
     for src in datasources:
-        for _, chunk in with_mmap(src, sprayer):
+        for _, chunk in sprayer(src):
             yield chunk
 
+@cached(
+    cache=LRUCache(maxsize=0x20)
+    , key=lambda name, params, data: hashkey(name, tuple(sorted(params.items())), data)
+    )
 def make_dryer(name, params, data):
+    '''
+    Builds the drying function for a configuration. Stores sharing a
+    configuration share the dryer, and with it the digested dictionary and
+    the compressors of each drying thread.
+    '''
     if name == 'nocompress':
         return lambda x: x
     if name == 'zstd':
         #This only supports levels for now
-        compressdict = ZstdDict(data)
+        compressdict = ZstdDict(data) if data else None
         level = params.get('level')
-        compressor = ZstdCompressor(
-            level_or_option=(params if level is None else level)
-            , zstd_dict=compressdict
-            )
-        return lambda x: compressor.compress(x, ZstdCompressor.FLUSH_FRAME)
+        if compressdict is not None and level is not None:
+            #Digested once per level and cached by ZstdDict, rather than
+            #loaded raw into the compression context
+            compressdict = compressdict.as_digested_dict
+        option = params if level is None else {CParameter.compressionLevel: level}
+        if compressdict is not None:
+            #The rehydrate row names the dictionary already, so every frame
+            #can leave out its ID; frames that carry one still decompress
+            option = {**option, CParameter.dictIDFlag: 0}
+        #Compressors lock around every call, so each drying thread gets its own
+        local = threading_local()
+        def dryer(x):
+            compressor = getattr(local, 'compressor', None)
+            if compressor is None:
+                compressor = local.compressor = ZstdCompressor(
+                    level_or_option=option
+                    , zstd_dict=compressdict
+                    )
+            return compressor.compress(x, ZstdCompressor.FLUSH_FRAME)
+        return dryer
     raise ValueError('Unsupported algorithm for drying:', name)
 
 def make_mksprayer_dryer_old(conn, name):
@@ -292,20 +677,7 @@ def make_mksprayer_dryer_old(conn, name):
         'SELECT id, chunking, algorithm, data FROM rehydrate WHERE name = ?'
         , (name,)
         ):
-        sprayer = make_sprayer(algosplit(chunker))
-        algoname, algoparams = algosplit(algorithm)
-        if algoname == 'nocompress':
-            return rehydrateID, sprayer, lambda x: x
-        if algoname == 'zstd':
-            #This only supports levels for now
-            compressdict = ZstdDict(data)
-            level = algoparams.get('level')
-            compressor = ZstdCompressor(
-                level_or_option=(params if level is None else level)
-                , zstd_dict=compressdict
-                )
-            return rehydrateID, sprayer, lambda x: compressor.compress(x, ZstdCompressor.FLUSH_FRAME)
-        raise ValueError('Unsupported algorithm for drying:', algorithm)
+        return rehydrateID, make_filesprayer(*algosplit(chunker)), make_dryer(*algosplit(algorithm), data)
 
 def algosplit(instr):
     parts = instr.strip().split()
@@ -345,20 +717,108 @@ def make_sprayer(algorithm, params):
             params.get('size', 0x2000)
             )
     if algorithm == 'crc32':
+        #A border where the top bits of the CRC are zero is a border where
+        #it falls below a power of two, so bits is just another spelling of
+        #cutoff and both share the one comparison in the scan
+        if 'bits' in params and 'cutoff' in params:
+            raise ValueError('Spraying algorithm crc32 takes either bits or cutoff', params)
         return mk_spray_crc32(
             params.get('initializer', 0xfacade00)
-            , params.get('cutoff', 0x000a0000)
+            , 1 << (32 - params['bits']) if 'bits' in params else params.get('cutoff', 0x000a0000)
+            , params.get('min', 0x0800)
+            , params.get('max', 0x4000)
+            )
+    if algorithm == 'gear':
+        bits = params.get('bits', 0x0d)
+        return mk_spray_gear(
+            bits
             , params.get('min', 0x0800)
             , params.get('max', 0x4000)
+            , params.get('norm', 0)
+            , params.get('avg', 1 << bits)
+            )
+    if algorithm == 'fastcdc':
+        if fastcdc_chunks is None:
+            raise ValueError('Spraying algorithm fastcdc needs the fastcdc package')
+        return mk_spray_fastcdc(
+            params.get('min', 0x0800)
+            , params.get('avg', 0x2000)
+            , params.get('max', 0x4000)
             )
     raise ValueError('Unsupported spraying algorithm', algorithm)
 
+def make_filesprayer(algorithm, params):
+    '''
+    Like make_sprayer, but spraying the file at a path. Fixed-size chunks
+    are read straight off the file; content-defined chunking looks at the
+    file as a whole, through a memory map.
+    '''
+    if algorithm == 'fixed':
+        size = params.get('size', 0x2000)
+        return lambda path: with_pread(path, size)
+    sprayer = make_sprayer(algorithm, params)
+    return lambda path: with_mmap(path, sprayer)
+
+def with_pread(path, size):
+    '''
+    Reads the file in consecutive pieces of size bytes, without the page
+    faults of going through a memory map. The kernel is told to expect
+    sequential access, so it reads ahead aggressively.
+    '''
+    fd = os_open(path, O_RDONLY)
+    try:
+        if posix_fadvise is not None:
+            posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        offset = 0
+        while True:
+            chunk = pread(fd, size, offset)
+            if not chunk:
+                break
+            yield offset, chunk
+            offset += len(chunk)
+    finally:
+        os_close(fd)
+
+def readahead(path, size):
+    '''
+    Asks the kernel to read the first size bytes of the file, without
+    waiting for the data. Opening does not block on special files, and
+    anything that cannot be read ahead is left alone.
+    '''
+    try:
+        fd = os_open(path, O_RDONLY | O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        posix_fadvise(fd, 0, size, POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os_close(fd)
+    return None
 
 def with_mmap(path, mksprayer):
-    with open(path, 'rb+') as handle:
-        with mmap(handle.fileno(), 0) as mm:
-            for res in mksprayer(mm):
-                yield res
+    '''
+    Sprays the file through a read-only memory map, telling the kernel the
+    map is read front to back. Empty files cannot be mapped and have no
+    chunks anyway.
+    The sprayer gets a memoryview, so chunks are views into the map rather
+    than copies. The map is closed once spraying is done, unless chunks
+    still refer to it; it is then unmapped once the last of them is gone.
+    '''
+    with open(path, 'rb') as handle:
+        if not fstat(handle.fileno()).st_size:
+            return
+        mm = mmap(handle.fileno(), 0, access=ACCESS_READ)
+    try:
+        if MADV_SEQUENTIAL is not None:
+            mm.madvise(MADV_SEQUENTIAL)
+        yield from mksprayer(memoryview(mm))
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            pass
 
 def mk_spray_fixed(size):
     def spray_fixed_size(indata):
@@ -366,20 +826,167 @@ def mk_spray_fixed(size):
             yield offset, indata[offset:offset+size]
     return spray_fixed_size
 
+def mk_spray_fastcdc(minimum, average, maximum):
+    '''
+    Content-defined chunking by the fastcdc package, which scans the buffer
+    in compiled code. Only the borders are taken from it, the chunks are
+    sliced here like with every other sprayer.
+    '''
+    def chunker(indata):
+        for chunk in fastcdc_chunks(
+            indata
+            , min_size=minimum
+            , avg_size=average
+            , max_size=maximum
+            ):
+            yield chunk.offset, indata[chunk.offset:chunk.offset + chunk.length]
+    return chunker
+
 def mk_spray_crc32(initializer, cutoff, minimum, maximum):
+    scans = compiled_scans()
+    borders = crc32_borders if scans is None else scans.crc32_borders_numba
     def chunker(indata):
         border = 0
-        rolling = initializer
-        for position, byte in enumerate(indata):
-            rolling = crc32(byte, rolling)
+        for position in borders(indata, initializer, cutoff, minimum):
+            for interior_border in range(border, position, maximum):
+                next_border = min(position, interior_border + maximum)
+                yield interior_border, indata[interior_border:next_border]
+            border = position
+        last_chunk = indata[border:]
+        if last_chunk:
+            yield border, last_chunk
+    return chunker
+
+def crc32_borders(indata, initializer, cutoff, minimum):
+    '''
+    Scans the data for chunk borders, i.e. positions at least minimum bytes
+    past the previous border where the running CRC32 drops below cutoff.
+    Splitting oversized chunks is left to the caller.
+    The CRC32 of a run of bytes equals feeding them one at a time, so the
+    stretch after each border that cannot hold another one is checksummed
+    in a single call; only the remainder goes byte by byte.
+    '''
+    borders = []
+    view = memoryview(indata).cast('c')
+    size = len(view)
+    checksum = crc32
+    border = 0
+    start = 0
+    rolling = initializer
+    while start < size:
+        skip = max(start, min(border + minimum, size))
+        rolling = checksum(view[start:skip], rolling)
+        start = size
+        for position, byte in enumerate(view[skip:], skip):
+            rolling = checksum(byte, rolling)
             if rolling < cutoff:
-                if position - border < minimum:
-                    continue
-                for interior_border in range(border, position, maximum):
-                    next_border = min(position, interior_border + maximum)
-                    yield interior_border, indata[interior_border:next_border]
+                borders.append(position)
                 border = position
+                start = position + 1
+                break
+    return borders
+
+'''
+With numba installed, the border scans run compiled, from
+spraydryfs.compiled. The CRC32 scan walks the bytes with the table-driven
+CRC32 that zlib uses, so the borders are exactly those of crc32_borders,
+minus the Python round trip per byte.
+'''
+
+@lru_cache(maxsize=None)
+def compiled_scans():
+    '''
+    The module of compiled border scans, or None without numba. It is
+    imported on first use, as numba and numpy are slow to load.
+    '''
+    try:
+        from spraydryfs import compiled
+    except ImportError:
+        return None
+    return compiled
+
+def crc32_table():
+    '''
+    The CRC32 lookup table, for the reflected polynomial zlib uses.
+    '''
+    table = []
+    for value in range(256):
+        for _ in range(8):
+            value = (value >> 1) ^ (0xedb88320 if value & 1 else 0)
+        table.append(value)
+    return table
+
+'''
+The Gear table maps every byte value to a pseudorandom 64 bit integer. It is
+derived from BLAKE2b rather than drawn at random since chunk borders, and
+with them every stored gear configuration, depend on it.
+'''
+
+GEAR = tuple(
+    int.from_bytes(blake2b(bytes([value]), digest_size=8, person=b'sprydrygear').digest(), 'little')
+    for value in range(256)
+    )
+
+def mk_spray_gear(bits, minimum, maximum, norm=0, average=None):
+    if not 0 < bits - norm <= bits + norm <= 64:
+        raise ValueError('Gear normalization out of range', bits, norm)
+    scans = compiled_scans()
+    borders = gear_borders if scans is None else scans.gear_borders_numba
+    def chunker(indata):
+        border = 0
+        for position in borders(indata, bits, minimum, maximum, norm, average):
+            yield border, indata[border:position]
+            border = position
         last_chunk = indata[border:]
         if last_chunk:
             yield border, last_chunk
     return chunker
+
+def gear_borders(indata, bits, minimum, maximum, norm=0, average=None):
+    '''
+    Scans the data for chunk borders with a Gear rolling hash. The hash only
+    spans the last 64 bytes, so borders depend on local content alone and an
+    insertion upsets only the chunks around it. The first minimum bytes of a
+    chunk are skipped, a border falls where the top bits of the hash are all
+    zero, and chunks are cut at maximum bytes otherwise. Borders are the
+    chunk ends up to, but excluding, the end of the data.
+    With normalization as in FastCDC, borders need norm more zero bits up to
+    average bytes into the chunk and norm fewer past it, which draws chunk
+    sizes towards average. Without it the hash is tested against bits
+    throughout.
+    '''
+    borders = []
+    table = GEAR
+    strict, loose = gear_masks(bits, norm)
+    normal = average if norm else 0
+    view = memoryview(indata).cast('B')
+    size = len(view)
+    border = 0
+    while size - border > minimum:
+        end = min(border + maximum, size)
+        middle = min(border + max(minimum, normal), end)
+        rolling = 0
+        position = end
+        for start, stop, mask in ((border + minimum, middle, strict), (middle, end, loose)):
+            for candidate, byte in enumerate(view[start:stop], start + 1):
+                rolling = ((rolling << 1) + table[byte]) & 0xffffffffffffffff
+                if not rolling & mask:
+                    position = candidate
+                    break
+            else:
+                continue
+            break
+        if position == size:
+            break
+        borders.append(position)
+        border = position
+    return borders
+
+def gear_masks(bits, norm):
+    '''
+    The masks a Gear hash is tested against before and after the average
+    chunk size, with bits plus and minus norm top bits set.
+    '''
+    strict = ((1 << (bits + norm)) - 1) << (64 - bits - norm)
+    loose = ((1 << (bits - norm)) - 1) << (64 - bits + norm)
+    return strict, loose